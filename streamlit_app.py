@@ -1,37 +1,192 @@
+import hashlib
+import io
+import os
+import tempfile
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
+import pydeck as pdk
 import matplotlib.pyplot as plt
-from folium.plugins import MarkerCluster
+from matplotlib.figure import Figure
+from folium.plugins import FastMarkerCluster
 from datetime import datetime
-from streamlit_folium import st_folium
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+# Opt-in Polars filter path for very large uploads: set USE_POLARS=1 with
+# polars installed. Everything else stays on pandas.
+USE_POLARS = pl is not None and os.environ.get('USE_POLARS') == '1'
+
+SITE_COLUMNS = ['MonitoringLocationName', 'LatitudeMeasure', 'LongitudeMeasure']
+CONTAMINANT_COLUMNS = [
+    'CharacteristicName', 'ResultMeasureValue', 'ActivityStartDate',
+    'MonitoringLocationIdentifier', 'LatitudeMeasure', 'LongitudeMeasure'
+]
+# Low-cardinality labels compared and grouped on every rerun
+CATEGORY_COLUMNS = ['CharacteristicName', 'MonitoringLocationIdentifier']
+
+# Parsed contaminant uploads are kept as Parquet in a private per-user
+# directory; only the most recently used files are kept.
+# Bump the version when parse_contaminant_csv changes so stale files are ignored.
+PARQUET_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wqp-parquet')
+PARQUET_CACHE_VERSION = 1
+PARQUET_CACHE_MAX_FILES = 8
+# The in-memory caches shared by all sessions hold as many uploads as the disk
+MEMORY_CACHE_MAX_UPLOADS = PARQUET_CACHE_MAX_FILES
+
+# Trend chart size and the dpi it is rendered to PNG at (st.pyplot's default,
+# passed explicitly so the two can't drift). Dates run along the vertical axis,
+# so a line can't show more distinct points than the rendered image has pixel
+# rows; longer series are averaged into that many time bins first.
+TREND_FIGSIZE = (12, 6)
+TREND_RENDER_DPI = 200
+TREND_MAX_POINTS = TREND_FIGSIZE[1] * TREND_RENDER_DPI
+
+# Client-side marker factory for FastMarkerCluster; each row is [lat, lon, popup].
+# Popup labels come from the upload, so they are bound as text, never as HTML.
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    var popup = document.createElement('div');
+    popup.textContent = String(row[2]);
+    marker.bindPopup(popup);
+    return marker;
+}
+"""
+
+# Only read the columns the app uses; lat/lon are optional in contaminant files
+def present_columns(file_bytes, wanted):
+    header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+    return [col for col in header if col in wanted]
 
 # Load and filter sites (Part 1)
-def load_and_filter_sites(file_path):
-    df = pd.read_csv(file_path, dtype=str)
+@st.cache_data(show_spinner=False)
+def load_and_filter_sites(file_bytes):
+    df = pd.read_csv(
+        io.BytesIO(file_bytes),
+        engine='pyarrow',
+        usecols=present_columns(file_bytes, SITE_COLUMNS)
+    )
+    # A single bad coordinate must become NaN, not fail the upload; these are
+    # no-ops when Arrow already inferred float columns
     df['LatitudeMeasure'] = pd.to_numeric(df.get('LatitudeMeasure'), errors='coerce')
     df['LongitudeMeasure'] = pd.to_numeric(df.get('LongitudeMeasure'), errors='coerce')
-    unique_sites = df.drop_duplicates(subset=['MonitoringLocationName', 'LatitudeMeasure', 'LongitudeMeasure'])
-    unique_sites = unique_sites.dropna(subset=['LatitudeMeasure', 'LongitudeMeasure'])
-    return unique_sites
+    df = df.dropna(subset=['LatitudeMeasure', 'LongitudeMeasure'])
+    # Coordinates at 6 decimals (~0.1 m) identify a station, so dedupe on one
+    # int64 key built from them instead of hashing three columns incl. names.
+    # Shifting both into non-negative ranges and scaling latitude past the
+    # 360e6 span of longitude makes the key unique per coordinate pair.
+    lat = df['LatitudeMeasure'].mul(1e6).round().astype('int64') + 90_000_000
+    lon = df['LongitudeMeasure'].mul(1e6).round().astype('int64') + 180_000_000
+    unique_sites = df[~(lat * 360_000_001 + lon).duplicated()]
+    return site_arrays(unique_sites, 'MonitoringLocationName')
 
-def plot_sites_on_map(sites_df):
-    if sites_df.empty:
+def plot_sites_on_map(coords, names):
+    if len(coords) == 0:
         raise ValueError("No valid monitoring sites to plot.")
-    m = folium.Map(
-        location=[sites_df['LatitudeMeasure'].mean(), sites_df['LongitudeMeasure'].mean()],
-        zoom_start=6
-    )
-    for _, row in sites_df.iterrows():
-        folium.Marker(
-            location=[row['LatitudeMeasure'], row['LongitudeMeasure']],
-            popup=row['MonitoringLocationName']
-        ).add_to(m)
-    return m
+    return build_map(coords, names)
+
+# The maps only need coordinates and a label, so pass them as plain arrays:
+# float32 (n, 2) lat/lon and fixed-width strings (which st.cache_* can hash)
+def site_arrays(sites_df, popup_col):
+    coords = sites_df[['LatitudeMeasure', 'LongitudeMeasure']].to_numpy(dtype=np.float32)
+    popups = sites_df[popup_col].astype(str).to_numpy(dtype=str)
+    return coords, popups
+
+# Build and render the map once per distinct set of points; reruns reuse the HTML.
+# All markers go to the browser as one array instead of one Marker per row.
+@st.cache_resource(show_spinner=False, max_entries=MEMORY_CACHE_MAX_UPLOADS)
+def build_map(coords, popups):
+    center = coords.mean(axis=0, dtype=np.float64)
+    m = folium.Map(location=center.tolist(), zoom_start=6)
+    data = [[lat, lon, popup] for (lat, lon), popup in zip(coords.tolist(), popups.tolist())]
+    FastMarkerCluster(data, callback=MARKER_CALLBACK).add_to(m)
+    return m.get_root().render()
 
 # Load the contaminant data (Part 2)
-def load_contaminant_data(file_path):
-    df = pd.read_csv(file_path)
+# Parsed uploads are also kept as Parquet on disk (see PARQUET_CACHE_DIR), so
+# re-uploading the same file or restarting the server skips the CSV parse.
+# cache_resource hands every rerun the same frame instead of unpickling a copy,
+# so callers must treat it (and the indices below) as read-only. It is keyed on
+# data_key (the upload's MD5) so reruns don't rehash the raw bytes.
+@st.cache_resource(show_spinner=False, max_entries=MEMORY_CACHE_MAX_UPLOADS)
+def load_contaminant_data(data_key, _file_bytes):
+    path = os.path.join(PARQUET_CACHE_DIR, f"wqp_{PARQUET_CACHE_VERSION}_{data_key}.parquet")
+    df = read_cached_parquet(path)
+    if df is None:
+        df = parse_contaminant_csv(_file_bytes)
+        write_cached_parquet(df, path)
+
+    # Slider bounds, so reruns don't rescan the columns
+    bounds = {
+        'value': (float(df['ResultMeasureValue'].min()), float(df['ResultMeasureValue'].max())),
+        'date': (
+            pd.to_datetime(df['ActivityStartDate'].min()).to_pydatetime(),
+            pd.to_datetime(df['ActivityStartDate'].max()).to_pydatetime()
+        )
+    }
+    return df, bounds
+
+# The cache is best-effort: a missing, unreadable or foreign file just means
+# the CSV gets parsed again
+def read_cached_parquet(path):
+    try:
+        df = pd.read_parquet(path)
+        os.utime(path)  # Mark as recently used for eviction
+        return df
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def write_cached_parquet(df, path):
+    tmp_path = None
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(PARQUET_CACHE_DIR, 0o700)
+        with tempfile.NamedTemporaryFile(dir=PARQUET_CACHE_DIR, suffix='.tmp', delete=False) as tmp:
+            tmp_path = tmp.name
+            df.to_parquet(tmp, compression='snappy')
+        os.replace(tmp_path, path)
+        tmp_path = None
+
+        # Evict the least recently used files beyond the limit
+        cached = [
+            entry for entry in os.scandir(PARQUET_CACHE_DIR)
+            if entry.name.endswith('.parquet') and entry.is_file(follow_symlinks=False)
+        ]
+        cached.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in cached[PARQUET_CACHE_MAX_FILES:]:
+            os.remove(entry.path)
+    except OSError:
+        pass  # The parsed frame is still usable without the cache
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def parse_contaminant_csv(file_bytes):
+    usecols = present_columns(file_bytes, CONTAMINANT_COLUMNS)
+    df = pd.read_csv(
+        io.BytesIO(file_bytes),
+        engine='pyarrow',
+        usecols=usecols,
+        dtype={col: 'category' for col in CATEGORY_COLUMNS if col in usecols},
+        parse_dates=['ActivityStartDate']
+    )
+    # ResultMeasureValue can hold text flags (e.g. "ND"), and any dates Arrow
+    # could not parse are left as strings, so coerce both; these are no-ops
+    # when Arrow already produced numeric/datetime columns.
     df['ResultMeasureValue'] = pd.to_numeric(df.get('ResultMeasureValue'), errors='coerce')
     df['ActivityStartDate'] = pd.to_datetime(df.get('ActivityStartDate'), errors='coerce')
 
@@ -39,28 +194,92 @@ def load_contaminant_data(file_path):
     if 'LatitudeMeasure' in df.columns and 'LongitudeMeasure' in df.columns:
         df['LatitudeMeasure'] = pd.to_numeric(df.get('LatitudeMeasure'), errors='coerce')
         df['LongitudeMeasure'] = pd.to_numeric(df.get('LongitudeMeasure'), errors='coerce')
+
+    # Rows without a date can never pass the date filter; dropping them and
+    # sorting by date lets filter_data find the date window by binary search.
+    df = df.dropna(subset=['ActivityStartDate'])
+    df = df.sort_values('ActivityStartDate', kind='stable').reset_index(drop=True)
     return df
 
-# Filter contaminant data based on user input
-def filter_data(df, contaminant, value_range, date_range):
-    filtered_df = df[df['CharacteristicName'] == contaminant]
-    filtered_df = filtered_df[
-        (filtered_df['ResultMeasureValue'] >= value_range[0]) &
-        (filtered_df['ResultMeasureValue'] <= value_range[1])
-    ]
-    date_range = [pd.to_datetime(date) for date in date_range]
-    filtered_df = filtered_df[
-        (filtered_df['ActivityStartDate'] >= date_range[0]) &
-        (filtered_df['ActivityStartDate'] <= date_range[1])
-    ]
-
-    # Add Latitude and Longitude if missing
-    if 'LatitudeMeasure' not in filtered_df.columns or 'LongitudeMeasure' not in filtered_df.columns:
-        if 'MonitoringLocationIdentifier' in df.columns:
-            lat_lon_df = df[['MonitoringLocationIdentifier', 'LatitudeMeasure', 'LongitudeMeasure']].drop_duplicates()
-            filtered_df = filtered_df.merge(lat_lon_df, on='MonitoringLocationIdentifier', how='left')
+# Row positions of each contaminant ordered by value, with the sorted values,
+# computed once per upload so value ranges can be found by binary search
+@st.cache_resource(show_spinner=False, max_entries=MEMORY_CACHE_MAX_UPLOADS)
+def contaminant_indices(_df, data_key):
+    values = _df['ResultMeasureValue'].to_numpy(dtype='float64')
+    indices = {}
+    for contaminant, positions in _df.groupby('CharacteristicName', observed=True).indices.items():
+        order = np.argsort(values[positions], kind='stable')  # NaN sorts last
+        indices[contaminant] = (positions[order], values[positions][order])
+    return indices
+
+# Polars copy of the contaminant frame, built once per upload
+@st.cache_resource(show_spinner=False, max_entries=MEMORY_CACHE_MAX_UPLOADS)
+def polars_frame(_df, data_key):
+    return pl.from_pandas(_df).lazy()
+
+# Same filter as the pandas path, run by Polars' multithreaded engine.
+# Filtering keeps row order, so the result is still sorted by date.
+def filter_with_polars(df, data_key, contaminant, value_range, date_range):
+    return (
+        polars_frame(df, data_key)
+        .filter(
+            (pl.col('CharacteristicName') == contaminant) &
+            pl.col('ResultMeasureValue').is_between(*value_range) &
+            pl.col('ActivityStartDate').is_between(*date_range)
+        )
+        .collect()
+        .to_pandas()
+    )
+
+# Filter contaminant data based on user input. Not cached: the binary-search
+# filter is cheaper than unpickling a cached result, and a cache would keep a
+# frame for every slider position. data_key (the upload's MD5) identifies df
+# for the per-upload caches it uses.
+def filter_data(df, data_key, contaminant, value_range, date_range):
+    if USE_POLARS:
+        filtered_df = filter_with_polars(df, data_key, contaminant, value_range, date_range)
+    else:
+        empty = np.empty(0, dtype=np.intp)
+        by_value, values = contaminant_indices(df, data_key).get(contaminant, (empty, empty))
+        keep = by_value[
+            np.searchsorted(values, value_range[0], side='left'):
+            np.searchsorted(values, value_range[1], side='right')
+        ]
+
+        # df is sorted by date, so the inclusive date window is one contiguous
+        # range of row positions; sorting what is left restores date order
+        dates = df['ActivityStartDate'].to_numpy()
+        start, end = np.array(date_range, dtype='datetime64[ns]').astype(dates.dtype)
+        first = np.searchsorted(dates, start, side='left')
+        last = np.searchsorted(dates, end, side='right')
+        filtered_df = df.take(np.sort(keep[(keep >= first) & (keep < last)]))
+
     return filtered_df
 
+# Assign sorted int64 dates to at most max_points time bins. Each distinct date
+# gets its own bin when there are few enough of them; otherwise the span is cut
+# into an even grid. Returns the bin of every date and the bin dates.
+def time_bins(dates, max_points):
+    is_new = np.empty(len(dates), dtype=bool)
+    is_new[0] = True
+    np.not_equal(dates[1:], dates[:-1], out=is_new[1:])
+    if is_new.sum() <= max_points:
+        return np.cumsum(is_new) - 1, dates[is_new]
+
+    start = dates[0]
+    span = dates[-1] - start + 1
+    bins = np.minimum(((dates - start) / span * max_points).astype('int64'), max_points - 1)
+    centres = start + ((np.arange(max_points) + 0.5) * span / max_points).astype('int64')
+    return bins, centres
+
+# Mean value per (group, bin) as an (n_groups, n_bins) array, NaN for empty bins
+def bin_means(codes, bins, values, n_bins, n_groups):
+    cells = codes * n_bins + bins
+    sums = np.bincount(cells, weights=values, minlength=n_groups * n_bins)
+    counts = np.bincount(cells, minlength=n_groups * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(n_groups, n_bins)
+
 # Plot the dual characteristics with switched axes
 def plot_dual_characteristics(df, characteristics):
     if not (1 <= len(characteristics) <= 2):
@@ -71,42 +290,77 @@ def plot_dual_characteristics(df, characteristics):
     value_col = 'ResultMeasureValue'
     char_col = 'CharacteristicName'
 
-    df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-    df = df.dropna(subset=[date_col, value_col, site_col, char_col])
-    df_filtered = df[df[char_col].isin(characteristics)]
-
-    plt.figure(figsize=(12, 6))
-    for (site, char), group in df_filtered.groupby([site_col, char_col]):
-        group_sorted = group.sort_values(date_col)
-        label = f"{site} - {char}"
-        plt.plot(group_sorted[value_col], group_sorted[date_col], label=label)
-
-    plt.title("Water Quality Characteristics Over Time (Switched Axes)")
-    plt.xlabel("Measured Value")
-    plt.ylabel("Date")
-    plt.legend(title="Site - Characteristic", bbox_to_anchor=(1.05, 1), loc="upper left")
-    plt.grid(True)
-    plt.tight_layout()
-    st.pyplot(plt)
-
-# Plot stations on map based on filtered data
+    # load_contaminant_data already parsed the dates and dropped undated rows
+    df = df.dropna(subset=[value_col, site_col, char_col])
+    # An Index uses isin's hashtable path; a categorical column matches it on codes
+    df_filtered = df[df[char_col].isin(pd.Index(characteristics))]
+
+    # One column per (site, characteristic), one row per time bin. Interpolating
+    # along the dates fills the gaps between a series' own samples with points
+    # on the segments joining them, so a single plot call draws the same lines.
+    wide = pd.DataFrame()
+    if not df_filtered.empty:
+        codes, labels = pd.MultiIndex.from_frame(df_filtered[[site_col, char_col]]).factorize()
+        # filter_data returns rows in date order, as time_bins expects
+        dates = df_filtered[date_col].to_numpy()
+        bins, bin_dates = time_bins(dates.view('int64'), TREND_MAX_POINTS)
+        means = bin_means(
+            codes, bins, df_filtered[value_col].to_numpy(dtype='float64'), len(bin_dates), len(labels)
+        )
+        wide = pd.DataFrame(means.T, index=bin_dates.view(dates.dtype), columns=labels)
+        wide = wide.dropna(how='all').interpolate(method='index', limit_area='inside')
+
+    fig, ax = trend_figure()
+    ax.clear()
+    if not wide.empty:
+        ax.plot(wide.to_numpy(), wide.index)
+        ax.legend(
+            [f"{site} - {char}" for site, char in wide.columns],
+            title="Site - Characteristic", bbox_to_anchor=(1.05, 1), loc="upper left"
+        )
+
+    ax.set_title("Water Quality Characteristics Over Time (Switched Axes)")
+    ax.set_xlabel("Measured Value")
+    ax.set_ylabel("Date")
+    ax.grid(True)
+    fig.tight_layout()
+    st.pyplot(fig, dpi=TREND_RENDER_DPI)
+
+# One trend figure per browser session, cleared and redrawn on each rerun.
+# It is built with Figure() rather than plt.figure(), so pyplot never tracks it.
+def trend_figure():
+    if 'trend_figure' not in st.session_state:
+        fig = Figure(figsize=TREND_FIGSIZE, dpi=TREND_RENDER_DPI)
+        st.session_state['trend_figure'] = (fig, fig.add_subplot())
+    return st.session_state['trend_figure']
+
+# Plot stations on map based on filtered data. Points are drawn by deck.gl as a
+# single WebGL layer, so the cost does not grow with one DOM marker per site.
 def plot_filtered_map(filtered_df):
     if 'LatitudeMeasure' not in filtered_df.columns or 'LongitudeMeasure' not in filtered_df.columns:
         st.warning("No location data to map.")
         return None
     unique_sites = filtered_df[['MonitoringLocationIdentifier', 'LatitudeMeasure', 'LongitudeMeasure']].drop_duplicates()
     unique_sites = unique_sites.dropna(subset=['LatitudeMeasure', 'LongitudeMeasure'])
+    if unique_sites.empty:
+        return None
+    unique_sites = unique_sites.astype({'MonitoringLocationIdentifier': str})
 
-    m = folium.Map(
-        location=[unique_sites['LatitudeMeasure'].mean(), unique_sites['LongitudeMeasure'].mean()],
-        zoom_start=6
+    layer = pdk.Layer(
+        'ScatterplotLayer',
+        data=unique_sites,
+        get_position='[LongitudeMeasure, LatitudeMeasure]',
+        get_radius=500,
+        radius_min_pixels=3,
+        get_fill_color=[200, 30, 0, 160],
+        pickable=True
     )
-    for _, row in unique_sites.iterrows():
-        folium.Marker(
-            location=[row['LatitudeMeasure'], row['LongitudeMeasure']],
-            popup=row['MonitoringLocationIdentifier']
-        ).add_to(m)
-    return m
+    view_state = pdk.ViewState(
+        latitude=unique_sites['LatitudeMeasure'].mean(),
+        longitude=unique_sites['LongitudeMeasure'].mean(),
+        zoom=6
+    )
+    return pdk.Deck(layers=[layer], initial_view_state=view_state, tooltip={'text': '{MonitoringLocationIdentifier}'})
 
 # Streamlit app layout
 def app():
@@ -114,14 +368,16 @@ def app():
 
     site_file = st.file_uploader("Upload Site Locations CSV", type="csv")
     if site_file is not None:
-        sites = load_and_filter_sites(site_file)
+        coords, names = load_and_filter_sites(site_file.getvalue())
         st.subheader("Stations with Monitoring Locations")
-        map_display = plot_sites_on_map(sites)
-        st_folium(map_display, width=700)
+        map_display = plot_sites_on_map(coords, names)
+        st.iframe(map_display, width=700, height=500)
 
     contaminant_file = st.file_uploader("Upload Contaminant Data CSV", type="csv")
     if contaminant_file is not None:
-        df = load_contaminant_data(contaminant_file)
+        file_bytes = contaminant_file.getvalue()
+        data_key = hashlib.md5(file_bytes).hexdigest()
+        df, bounds = load_contaminant_data(data_key, file_bytes)
 
         if 'CharacteristicName' not in df.columns:
             st.error("CSV must include a 'CharacteristicName' column.")
@@ -130,23 +386,24 @@ def app():
         contaminants = df['CharacteristicName'].dropna().unique()
         contaminant = st.selectbox("Select Contaminant", contaminants)
 
-        min_value = df['ResultMeasureValue'].min()
-        max_value = df['ResultMeasureValue'].max()
-        value_range = st.slider("Select Value Range", float(min_value), float(max_value), (float(min_value), float(max_value)))
+        min_value, max_value = bounds['value']
+        value_range = st.slider("Select Value Range", min_value, max_value, (min_value, max_value))
 
-        min_date = pd.to_datetime(df['ActivityStartDate'].min()).to_pydatetime()
-        max_date = pd.to_datetime(df['ActivityStartDate'].max()).to_pydatetime()
+        min_date, max_date = bounds['date']
         date_range = st.slider("Select Date Range", min_value=min_date, max_value=max_date, value=(min_date, max_date))
 
-        filtered_df = filter_data(df, contaminant, value_range, date_range)
+        filtered_df = filter_data(df, data_key, contaminant, value_range, date_range)
 
         st.subheader(f"Stations with the Selected Contaminant ({contaminant})")
         filtered_map = plot_filtered_map(filtered_df)
-        if filtered_map:
-            st_folium(filtered_map, width=700)
+        if filtered_map is not None:
+            st.pydeck_chart(filtered_map)
 
         st.subheader(f"Trend of {contaminant} Over Time")
         plot_dual_characteristics(filtered_df, [contaminant])
 
+    # Nothing here draws through pyplot any more; close any stray figures
+    plt.close('all')
+
 if __name__ == "__main__":
     app()